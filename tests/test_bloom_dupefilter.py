@@ -0,0 +1,59 @@
+import hashlib
+import shutil
+import tempfile
+
+from scrapy import Request
+from scrapy.utils.test import get_crawler
+from twisted.trial import unittest
+
+from webscrapy.bloom_dupefilter import BloomDupeFilter, BloomFilter
+
+
+class BloomFilterTest(unittest.TestCase):
+    def test_sizes_for_capacity_and_error_rate(self):
+        bloom = BloomFilter(capacity=1_000_000, error_rate=1e-4)
+        self.assertEqual(bloom.size, 19_170_117)
+        self.assertEqual(bloom.hashes, 13)
+        self.assertEqual(len(bloom.bits), (bloom.size + 7) // 8)
+
+    def test_add_reports_seen_digests(self):
+        bloom = BloomFilter(capacity=10_000, error_rate=1e-3)
+        digests = [hashlib.sha1(str(i).encode()).digest() for i in range(20_000)]
+        self.assertLessEqual(sum(bloom.add(digest) for digest in digests[:10_000]), 10)
+        self.assertTrue(all(bloom.add(digest) for digest in digests[:10_000]))
+
+        # Digests never added are false positives at about the error rate.
+        def contains(digest: bytes) -> bool:
+            return all(bloom.bits[position // 8] & (1 << position % 8)
+                       for position in bloom.positions(digest))
+        self.assertLessEqual(sum(map(contains, digests[10_000:])), 30)
+
+
+class BloomDupeFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.job_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.job_dir)
+
+    def dupefilter(self) -> BloomDupeFilter:
+        crawler = get_crawler(settings_dict={"JOBDIR": self.job_dir,
+                                             "BLOOM_DUPEFILTER_CAPACITY": 1_000})
+        dupefilter = BloomDupeFilter.from_crawler(crawler)
+        self.addCleanup(dupefilter.close, "finished")
+        return dupefilter
+
+    def test_request_seen(self):
+        dupefilter = self.dupefilter()
+        self.assertFalse(dupefilter.request_seen(Request("http://example.com/a")))
+        self.assertTrue(dupefilter.request_seen(Request("http://example.com/a")))
+        self.assertFalse(dupefilter.request_seen(Request("http://example.com/b")))
+
+    def test_resumes_from_job_dir(self):
+        dupefilter = self.dupefilter()
+        dupefilter.request_seen(Request("http://example.com/a"))
+        dupefilter.close("shutdown")
+
+        resumed = self.dupefilter()
+        self.assertTrue(resumed.request_seen(Request("http://example.com/a")))
+        self.assertFalse(resumed.request_seen(Request("http://example.com/b")))
@@ -0,0 +1,115 @@
+import gzip
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from scrapy.utils.test import get_crawler
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+from twisted.web import resource, server
+
+from webscrapy import streaming
+from webscrapy.get_all_spider import GetAllSpider
+
+INDEX = (b'<html><body><script src="/app.js"></script><img src="/image.bin">'
+         b'<a href="/large.bin">large</a></body></html>')
+SCRIPT = b"console.log('webscrapy');\n" * 64
+IMAGE = bytes(range(256)) * 64
+VIDEO = bytes(range(256)) * 16_384
+
+
+class StaticResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, body: bytes, content_type: bytes, content_encoding: bytes = None):
+        super().__init__()
+        self.body = body
+        self.content_type = content_type
+        self.content_encoding = content_encoding
+
+    def render_GET(self, request):
+        request.setHeader(b"content-type", self.content_type)
+        if self.content_encoding is None:
+            return self.body
+        request.setHeader(b"content-encoding", self.content_encoding)
+        return gzip.compress(self.body)
+
+
+class ChunkedResource(StaticResource):
+    # Writing without a Content-Length makes the size known only while downloading.
+    def render_GET(self, request):
+        request.setHeader(b"content-type", self.content_type)
+        for start in range(0, len(self.body), 1024):
+            request.write(self.body[start:start + 1024])
+        request.finish()
+        return server.NOT_DONE_YET
+
+
+class StreamingDownloadHandlerTest(unittest.TestCase):
+    def setUp(self):
+        root = resource.Resource()
+        root.putChild(b"", StaticResource(INDEX, b"text/html; charset=utf-8"))
+        root.putChild(b"app.js", StaticResource(SCRIPT, b"application/javascript", b"gzip"))
+        root.putChild(b"image.bin", StaticResource(IMAGE, b"application/octet-stream"))
+        root.putChild(b"large.bin", ChunkedResource(IMAGE * 4, b"application/octet-stream"))
+        root.putChild(b"video.bin", ChunkedResource(VIDEO, b"video/mp4"))
+        self.port = reactor.listenTCP(0, server.Site(root), interface="127.0.0.1")
+        self.url = f"http://127.0.0.1:{self.port.getHost().port}/"
+        self.save_dir = Path(tempfile.mkdtemp())
+        self.site_dir = self.save_dir / f"127.0.0.1:{self.port.getHost().port}"
+
+    def tearDown(self):
+        shutil.rmtree(self.save_dir)
+        return self.port.stopListening()
+
+    @inlineCallbacks
+    def crawl(self, path: str = "", **settings):
+        crawler = get_crawler(GetAllSpider, settings_dict={
+            "DOWNLOAD_HANDLERS": {"http": "webscrapy.streaming.StreamingDownloadHandler"},
+            "RETRY_ENABLED": False,
+            **settings})
+        yield crawler.crawl(url=self.url + path, **{"save-dir": str(self.save_dir)})
+        return crawler
+
+    @inlineCallbacks
+    def test_saves_decoded_and_streamed_bodies(self):
+        yield self.crawl()
+        self.assertEqual((self.site_dir / "index.html").read_bytes(), INDEX)
+        # Content-encoded bodies are not streamed, so they are saved decoded.
+        self.assertEqual((self.site_dir / "app.js").read_bytes(), SCRIPT)
+        self.assertEqual((self.site_dir / "image.bin").read_bytes(), IMAGE)
+
+    @inlineCallbacks
+    def test_keeps_existing_files(self):
+        self.site_dir.mkdir(parents=True)
+        (self.site_dir / "image.bin").write_bytes(b"saved")
+        with self.assertNoLogs("getallspider", level="ERROR"):
+            yield self.crawl()
+        self.assertEqual((self.site_dir / "image.bin").read_bytes(), b"saved")
+
+    @inlineCallbacks
+    def test_discards_body_over_maxsize(self):
+        crawler = yield self.crawl(DOWNLOAD_MAXSIZE=len(IMAGE) * 2)
+        self.assertEqual(crawler.stats.get_value("downloader/exception_count"), 1)
+        self.assertEqual(crawler.stats.get_value(
+            "downloader/exception_type_count/twisted.internet.defer.CancelledError"), 1)
+        self.assertEqual((self.site_dir / "image.bin").read_bytes(), IMAGE)
+        self.assertFalse((self.site_dir / "large.bin").exists())
+
+    @inlineCallbacks
+    def test_waits_for_slow_writes(self):
+        write = streaming._write
+        sizes = []
+
+        def slow_write(file, data):
+            sizes.append(len(data))
+            time.sleep(0.05)
+            write(file, data)
+
+        self.patch(streaming, "_write", slow_write)
+        yield self.crawl("video.bin")
+        self.assertEqual((self.site_dir / "video.bin").read_bytes(), VIDEO)
+        # Network chunks are merged into writes of SAVE_FILE_BUFFER_SIZE bytes.
+        self.assertEqual(sizes, [GetAllSpider.SAVE_FILE_BUFFER_SIZE] * 4)
@@ -0,0 +1,3 @@
+from webscrapy.get_all_spider import GetAllSpider
+
+__all__ = ["GetAllSpider"]
@@ -0,0 +1,63 @@
+import math
+import os
+from typing import Optional
+
+from scrapy import Request
+from scrapy.dupefilters import RFPDupeFilter
+from scrapy.utils.job import job_dir
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.size: int = max(size, 8)
+        self.hashes: int = max(round(self.size / capacity * math.log(2)), 1)
+        self.bits: bytearray = bytearray((self.size + 7) // 8)
+
+    def positions(self, digest: bytes) -> [int]:
+        # Double hashing over the fingerprint, which is already a uniform hash.
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:16], "big") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, digest: bytes) -> bool:
+        seen = True
+        for position in self.positions(digest):
+            byte, bit = divmod(position, 8)
+            if not self.bits[byte] & (1 << bit):
+                self.bits[byte] |= 1 << bit
+                seen = False
+        return seen
+
+
+class BloomDupeFilter(RFPDupeFilter):
+    DEFAULT_CAPACITY: int = 10_000_000
+    DEFAULT_ERROR_RATE: float = 1e-4
+
+    def __init__(self, path: Optional[str] = None, debug: bool = False, *, fingerprinter=None,
+                 capacity: int = DEFAULT_CAPACITY, error_rate: float = DEFAULT_ERROR_RATE):
+        # The parent class would load every persisted fingerprint into a set.
+        super().__init__(None, debug, fingerprinter=fingerprinter)
+        self.bloom = BloomFilter(capacity, error_rate)
+        if path:
+            self.file = open(os.path.join(path, "requests.seen"), "a+")
+            self.file.seek(0)
+            for line in self.file:
+                self.bloom.add(bytes.fromhex(line.rstrip()))
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        return cls(job_dir(settings),
+                   settings.getbool("DUPEFILTER_DEBUG"),
+                   fingerprinter=crawler.request_fingerprinter,
+                   capacity=settings.getint("BLOOM_DUPEFILTER_CAPACITY", cls.DEFAULT_CAPACITY),
+                   error_rate=settings.getfloat("BLOOM_DUPEFILTER_ERROR_RATE", cls.DEFAULT_ERROR_RATE))
+
+    def request_seen(self, request: Request) -> bool:
+        fp = self.fingerprinter.fingerprint(request)
+        if self.bloom.add(fp):
+            return True
+        if self.file:
+            self.file.write(fp.hex() + "\n")
+        return False
@@ -3,14 +3,49 @@ import logging
 import mimetypes
 import os
 import re
+from functools import lru_cache
 from pathlib import Path
 from typing import Any
+from typing import BinaryIO
 from typing import Iterable
 from urllib.parse import urlparse
 
+from lxml import etree
 from scrapy import Request, Spider
 from scrapy.crawler import CrawlerProcess
 from scrapy.http import Response
+from twisted.internet.defer import Deferred
+from twisted.internet.threads import deferToThread
+
+_RE_NULL = re.compile(r"\0")
+_RE_HAS_EXT = re.compile(r".*/.+\.[a-zA-Z0-9]{2,10}$")
+_RE_IGNORE = re.compile(r"^(mailto|javascript|xmpp|urn|tel):|^#$|^#[^/]+$|^$")
+# Compiled XPath objects are thread-safe for evaluation, so one instance is shared by every response.
+# Plain strings, unlike lxml's smart strings, keep no reference to the parsed tree.
+_REF_XPATH = etree.XPath("//a/@href|//link/@href|//script/@src|//img/@src|//base/@href|//area/@href",
+                         smart_strings=False)
+
+
+def _media_type(content_type: str) -> str:
+    # Content type without parameters such as charset, e.g. "text/html".
+    return content_type.split(";", 1)[0].strip().lower()
+
+
+@lru_cache(maxsize=128)
+def _guess_extension(media_type: str) -> str | None:
+    return mimetypes.guess_extension(media_type)
+
+
+def _hostname(url: str) -> str:
+    # Cheaper than urlparse() for the absolute URLs built by follow_links().
+    netloc = url.partition("://")[2]
+    for delimiter in "/?#":
+        netloc = netloc.partition(delimiter)[0]
+    host = netloc.rpartition("@")[2]
+    # IPv6 hosts are bracketed and contain colons, e.g. "[::1]:8080".
+    if host.startswith("["):
+        return host[1:].partition("]")[0].lower()
+    return host.partition(":")[0].lower()
 
 
 class GetAllSpider(Spider):
@@ -21,10 +56,17 @@ class GetAllSpider(Spider):
     only_links: bool = False
     also_save_links: bool = False
     regex_allowed_urls: str = None
+    links_file: BinaryIO = None
+    created_dirs: set = None
 
     CONTENT_TYPE_HTML: str = "text/html"
-    SELECT_REF_XPATH: str = "//a/@href|//link/@href|//script/@src|//img/@src|//base/@href|//area/@href"
-    REGEX_IGNORE_LINKS = r"^(mailto|javascript|xmpp|urn|tel):|^#$|^#[^/]+$|^$"
+    SELECT_REF_XPATH: str = _REF_XPATH.path
+    REGEX_IGNORE_LINKS = _RE_IGNORE.pattern
+    ABSOLUTE_URL_PREFIXES: tuple = ("http://", "https://")
+    LINKS_FILE_BUFFER_SIZE: int = 1 << 20
+    SAVE_FILE_BUFFER_SIZE: int = 1 << 20
+    BUFFERED_CONTENT_TYPES: tuple = ("text/html", "text/css", "application/xml")
+    SAME_HOST_PRIORITY: int = 10
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -36,8 +78,18 @@ class GetAllSpider(Spider):
         if self.regex_allowed_urls is None:
             self.regex_allowed_urls = r".*"
 
-        self.compiled_regex_ignore_link = re.compile(pattern=self.REGEX_IGNORE_LINKS)
-        self.compiled_regex_allowed_urls = re.compile(pattern=fr"{self.regex_allowed_urls}")
+        # The default pattern is shared; only an overridden one is compiled.
+        self.compiled_regex_ignore_link = _RE_IGNORE
+        if self.REGEX_IGNORE_LINKS != _RE_IGNORE.pattern:
+            self.compiled_regex_ignore_link = re.compile(pattern=self.REGEX_IGNORE_LINKS)
+
+        self.compiled_ref_xpath = _REF_XPATH
+        if self.SELECT_REF_XPATH != _REF_XPATH.path:
+            self.compiled_ref_xpath = etree.XPath(self.SELECT_REF_XPATH, smart_strings=False)
+        # The default pattern matches every URL, so it is not compiled nor matched.
+        self.compiled_regex_allowed_urls = None
+        if self.regex_allowed_urls != r".*":
+            self.compiled_regex_allowed_urls = re.compile(pattern=self.regex_allowed_urls)
 
         self.url = getattr(self, "url", None)
         if self.url is None:
@@ -54,96 +106,152 @@ class GetAllSpider(Spider):
         if self.save_dir is None:
             self.save_dir = os.curdir + f"/{self.domain}"
 
+        self.created_dirs = set()
         if not self.only_links or self.also_save_links:
             save_dir_path = Path(self.save_dir)
             save_dir_path.mkdir(parents=True, exist_ok=True, mode=0o777)
 
+        if self.only_links or self.also_save_links:
+            self.links_file = open(file=f"{self.domain}-links.txt", mode="ab",
+                                   buffering=self.LINKS_FILE_BUFFER_SIZE)
+
+    def closed(self, reason: str):
+        if self.links_file is not None:
+            self.links_file.close()
+            self.links_file = None
+
     def start_requests(self) -> Iterable[Request]:
         yield Request(url=self.url, callback=self.parse)
 
     def segments(self, url: str) -> [str]:
-        url_path: str = re.compile(r"^.+://|/$").sub(repl="", string=url)
-        return re.split(pattern="/", string=url_path)
+        scheme_end = url.find("://")
+        url_path: str = url[scheme_end + 3:] if scheme_end >= 0 else url
+        if url_path.endswith("/"):
+            url_path = url_path[:-1]
+        return url_path.split("/")
 
-    def create_physical_path(self, url: str, content_type: str) -> Path:
+    def physical_path(self, url: str, content_type: str) -> Path:
         segs = self.segments(url)
         dir_path = self.save_dir + os.sep
-        filename = re.compile(pattern=r"\\0").sub(repl="", string=segs[-1])[:255]
+        filename = _RE_NULL.sub(repl="", string=segs[-1])[:255]
         filepath = None
 
         # Remove charset of content type.
-        file_ext = mimetypes.guess_extension(re.sub(pattern=";.*", repl="", string=content_type))
+        file_ext = _guess_extension(_media_type(content_type))
         parsed_url = urlparse(url)
 
         # Not exist file's extension for URL
-        if not re.compile(pattern=r".*/.+\.[a-zA-Z0-9]{2,10}$").match(parsed_url.path) and not parsed_url.query:
+        if not _RE_HAS_EXT.match(parsed_url.path) and not parsed_url.query:
             dir_path += os.sep.join(segs)
             filepath = dir_path + f"/index{file_ext}"
         # Exist at least a "query" into URL.
         else:
             dir_path += os.sep.join(segs[:-1])
             filepath = dir_path + os.sep + filename
-        self.log(f"filepath: {filepath}")
+        self.logger.debug("filepath: %s", filepath)
+        return Path(filepath)
 
-        path = Path(dir_path)
-        path.mkdir(parents=True, exist_ok=True, mode=0o777)
+    def create_dirs(self, path: Path):
+        dir_path = str(path.parent)
+        # Saves run on the thread pool, but a racing mkdir(exist_ok=True) is harmless.
+        if dir_path not in self.created_dirs:
+            path.parent.mkdir(parents=True, exist_ok=True, mode=0o777)
+            self.created_dirs.add(dir_path)
 
+    def create_physical_path(self, url: str, content_type: str) -> Path:
+        path = self.physical_path(url, content_type)
+        self.create_dirs(path)
+        return path
+
+    def open_file(self, path: Path) -> BinaryIO:
+        # "x" mode creates the file exclusively, failing if it already exists.
+        mode = "wb" if self.override else "xb"
         try:
-            path = Path(filepath)
-            path.touch(mode=0o777, exist_ok=self.override)
-            return path
+            return open(file=path, mode=mode, buffering=self.SAVE_FILE_BUFFER_SIZE)
         except FileExistsError as error:
-            self.log(f"file {filepath} exists!")
+            self.log(f"file {path} exists!")
             raise error
 
     def save_file(self, url: str, content_type: str, data: bytes):
-        try:
-            path = self.create_physical_path(url, content_type)
-            file = open(file=f"{str(path.absolute())}", mode='wb')
+        path = self.create_physical_path(url, content_type)
+        with self.open_file(path) as file:
             file.write(data)
-            file.close()
+
+    def streams(self, content_type: str) -> bool:
+        # Asked by StreamingDownloadHandler before the body is downloaded;
+        # False keeps the body in memory for parse().
+        if self.only_links and not self.also_save_links:
+            return False
+        return _media_type(content_type) not in self.BUFFERED_CONTENT_TYPES
+
+    def open_stream(self, path: Path) -> BinaryIO | None:
+        # Runs on the reactor thread pool; None drops the streamed body.
+        try:
+            self.create_dirs(path)
+            return self.open_file(path)
+        except FileExistsError:
+            # Already logged by open_file(); the saved file is kept.
+            return None
         except Exception as ex:
-            raise ex
+            self.log(ex, logging.ERROR)
+            return None
 
     def save_link(self, url: str):
-        fin = open(file=f"{self.domain}-links.txt", mode="at", encoding='utf8')
-        fin.write(f"{url}\n")
-        fin.close()
+        self.links_file.write(url.encode("utf8") + b"\n")
 
-    def parse(self, response: Response, **kwargs: Any):
-        self.log(f"headers=[{response.headers}], url=[{response.url}]")
-        content_type: str = response.headers["content-type"].decode("ascii")
+    def extract_links(self, response: Response) -> [str]:
+        root = response.selector.root
+        if etree.iselement(root):
+            return self.compiled_ref_xpath(root)
+        return response.xpath(self.SELECT_REF_XPATH).getall()
 
+    def save_response(self, response: Response, content_type: str):
         try:
             if self.only_links or self.also_save_links:
                 self.save_link(response.url)
 
-            if not self.only_links or self.also_save_links:
+            # Streamed responses were already handled while downloading.
+            if (not self.only_links or self.also_save_links) and "saved_path" not in response.meta:
                 self.save_file(response.url, content_type, response.body)
         except Exception as ex:
             self.log(ex, logging.ERROR)
 
-        if self.CONTENT_TYPE_HTML in content_type.lower():
-            try:
-                links = response.xpath(self.SELECT_REF_XPATH).getall()
-                follows = list()
-                for link in links:
-                    if self.compiled_regex_ignore_link.match(link):
-                        continue
-
-                    parsed_url = urlparse(url=link)
-                    if parsed_url.hostname is None:
-                        link = response.urljoin(link)
-
-                    if self.compiled_regex_allowed_urls.match(link):
-                        follows.append(link)
-
-                #self.log(f"follows: {follows}")
-                yield from response.follow_all(urls=follows, callback=self.parse)
-            except Exception as error:
-                self.log(error, level=logging.ERROR)
-        else:
-            return None
+    def parse(self, response: Response, **kwargs: Any) -> Deferred:
+        self.logger.debug("headers=[%s], url=[%s]", response.headers, response.url)
+        content_type: str = response.headers["content-type"].decode("ascii")
+
+        # Disk writes run on the reactor thread pool; Scrapy waits for the
+        # returned Deferred before processing the callback output.
+        saved = deferToThread(self.save_response, response, content_type)
+
+        # Non-HTML responses are only copied to disk: no selector is built and
+        # no generator is created, so Scrapy can release the body once written.
+        if _media_type(content_type) != self.CONTENT_TYPE_HTML:
+            return saved
+        return saved.addCallback(lambda _: self.follow_links(response))
+
+    def follow_links(self, response: Response) -> Iterable[Request]:
+        try:
+            # Bound methods are kept in locals to avoid attribute lookups per link.
+            ignore = self.compiled_regex_ignore_link.match
+            urljoin = response.urljoin
+            prefixes = self.ABSOLUTE_URL_PREFIXES
+
+            # Dicts keep the page order while dropping repeated references.
+            links = dict.fromkeys(self.extract_links(response))
+            follows = list(dict.fromkeys(link if link.startswith(prefixes) else urljoin(link)
+                                         for link in links
+                                         if not ignore(link)))
+            if self.compiled_regex_allowed_urls is not None:
+                allowed = self.compiled_regex_allowed_urls.match
+                follows = [url for url in follows if allowed(url)]
+
+            self.logger.debug("follows: %s", follows)
+            for url in follows:
+                priority = self.SAME_HOST_PRIORITY if _hostname(url) == self.domain else 0
+                yield Request(url=url, callback=self.parse, priority=priority, encoding=response.encoding)
+        except Exception as error:
+            self.log(error, level=logging.ERROR)
 
 
 def main():
@@ -170,27 +278,41 @@ def main():
                         help="Also save page links.")
     parser.add_argument("--persist", dest="persist", type=bool, default=True, help="Persist crawls in user's home.")
     parser.add_argument("--enable-telnet", dest="enable_telnet", type=bool, default=False, help="Enable telnet connection.")
+    parser.add_argument("--enable-http2", dest="enable_http2", type=bool, default=False,
+                        help="Use HTTP/2 for https URLs (requires Twisted[http2]).")
+    parser.add_argument("--enable-retry", dest="enable_retry", type=bool, default=False,
+                        help="Retry failed requests.")
     args = parser.parse_args()
 
     parsed_url = urlparse(args.url)
 
     crawler_process_settings = {
         "CONCURRENT_REQUESTS_PER_DOMAIN": args.requests_per_domain,
-        "CONCURRENT_REQUESTS": args.requests_per_domain * 2,
+        "CONCURRENT_REQUESTS": max(args.requests_per_domain * 2, 100),
         "AUTOTHROTTLE_TARGET_CONCURRENCY": args.requests_per_domain,
         "DOWNLOAD_DELAY": args.delay,
         "RANDOMIZE_DOWNLOAD_DELAY": args.randomize_delay,
-        "DEPTH_STATS_VERBOSE": True,
         "DOWNLOAD_MAXSIZE": 0,
         "REACTOR_THREADPOOL_MAXSIZE": 1024,
         "ROBOTSTXT_OBEY": False,
         "ROBOTSTXT_ENABLED": False,
         "SCHEDULER_DISK_QUEUE": "scrapy.squeues.PickleFifoDiskQueue",
         "SCHEDULER_MEMORY_QUEUE": "scrapy.squeues.FifoMemoryQueue",
+        "SCHEDULER_PRIORITY_QUEUE": "scrapy.pqueues.DownloaderAwarePriorityQueue",
+        "DNSCACHE_ENABLED": True,
+        "DNSCACHE_SIZE": 10_000,
+        "DNS_TIMEOUT": 20,
+        "AJAXCRAWL_ENABLED": True,
+        "TWISTED_REACTOR": "twisted.internet.asyncioreactor.AsyncioSelectorReactor",
+        "DUPEFILTER_CLASS": "webscrapy.bloom_dupefilter.BloomDupeFilter",
+        "HTTPCACHE_ENABLED": False,
+        "DOWNLOAD_HANDLERS": {
+            "http": "webscrapy.streaming.StreamingDownloadHandler",
+            "https": "webscrapy.streaming.StreamingDownloadHandler"},
         "SCRAPER_SLOT_MAX_ACTIVE_SIZE": 8_388_608,
         "REDIRECT_ENABLED": True,
         "REDIRECT_MAX_TIMES": 15,
-        "RETRY_ENABLED": True,
+        "RETRY_ENABLED": args.enable_retry,
         "RETRY_TIMES": 5,
         "DEFAULT_REQUEST_HEADERS": {
             "User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/115.0",
@@ -206,9 +328,9 @@ def main():
             "Cache-Control": "max-age=0"},
         "DEPT_STATS": True,
         "LOG_ENABLED": True,
-        "LOG_STDOUT": True,
+        "LOG_STDOUT": False,
         "LOG_FILE_APPEND": args.enable_log_file,
-        "LOG_LEVEL": "DEBUG",
+        "LOG_LEVEL": "INFO",
         "TELNETCONSOLE_USERNAME": "scrapy",
         "TELNETCONSOLE_PASSWORD": "scrapy",
         "TELNETCONSOLE_ENABLED": args.enable_telnet
@@ -219,6 +341,10 @@ def main():
     elif args.enable_log_file:
         crawler_process_settings["LOG_FILE"] = args.log_filename
 
+    if args.enable_http2:
+        crawler_process_settings["DOWNLOAD_HANDLERS"]["https"] = \
+            "scrapy.core.downloader.handlers.http2.H2DownloadHandler"
+
     if args.persist:
         crawler_process_settings["JOBDIR"] = f"./jobdir/{parsed_url.hostname}"
         crawler_process_settings["SCHEDULER_DEBUG"] = True
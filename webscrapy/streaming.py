@@ -0,0 +1,186 @@
+import logging
+import os
+from typing import BinaryIO, Callable, Optional
+
+from scrapy import Request, Spider
+from scrapy.core.downloader.handlers.http11 import HTTP11DownloadHandler, ScrapyAgent
+from twisted.internet.defer import Deferred, DeferredList, inlineCallbacks
+from twisted.internet.threads import deferToThread
+from twisted.python.failure import Failure
+
+logger = logging.getLogger(__name__)
+
+
+def _write(file: BinaryIO, data: bytes):
+    try:
+        file.write(data)
+    except Exception:
+        _discard(file)
+        raise
+
+
+def _close(file: BinaryIO):
+    file.close()
+
+
+def _discard(file: BinaryIO):
+    file.close()
+    os.unlink(file.name)
+
+
+def _log_failure(failure: Failure):
+    logger.error("Could not stream response body: %s", failure.getErrorMessage())
+
+
+class StreamedBody:
+    # Stands in for the BytesIO buffer of Scrapy's response reader, so that
+    # body chunks go to disk as they arrive instead of accumulating in memory.
+    # Chunks are merged into writes of write_size bytes, and the opening,
+    # writing and closing run in order on the reactor thread pool.
+    def __init__(self, reader, opened: Deferred, write_size: int, finishing: set):
+        self.reader = reader
+        # Fires with the target file, or None when the body is dropped.
+        self.file: Deferred = opened
+        self.write_size = write_size
+        self.finishing = finishing
+        self.chunks: [bytes] = []
+        self.buffered = 0
+        self.queued = 0
+        self.paused = False
+
+    def _then(self, function: Callable, *args, size: int = 0):
+        def call(file: Optional[BinaryIO]):
+            if file is None:
+                return None
+            return deferToThread(function, file, *args).addCallback(lambda _: file)
+        self.file.addCallback(call)
+        self.file.addBoth(self._written, size)
+
+    def _written(self, result, size: int):
+        self.queued -= size
+        if self.paused and self.queued <= self.write_size:
+            self.paused = False
+            self.reader.transport.resumeProducing()
+        return result
+
+    def _flush(self):
+        if not self.chunks:
+            return
+        data = b"".join(self.chunks)
+        self.chunks = []
+        self.buffered = 0
+        self.queued += len(data)
+        self._then(_write, data, size=len(data))
+
+    def _finish(self, function: Callable):
+        self._then(function)
+        self.file.addErrback(_log_failure)
+        # Tracked until the file is closed, so the handler can wait for it.
+        done = Deferred()
+        self.finishing.add(done)
+        done.addCallback(lambda _: self.finishing.discard(done))
+        self.file.addCallback(done.callback)
+
+    def write(self, data: bytes) -> int:
+        self.chunks.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.write_size:
+            self._flush()
+            # Stop reading from the socket while more than one write is waiting.
+            if self.queued > self.write_size and not self.paused:
+                self.paused = True
+                self.reader.transport.pauseProducing()
+        return len(data)
+
+    def truncate(self, size: int = 0) -> int:
+        # Only called once download_maxsize is exceeded, right before the
+        # download is cancelled, which discards the partial file.
+        self.chunks = []
+        self.buffered = 0
+        return size
+
+    def getvalue(self) -> bytes:
+        self._flush()
+        self._finish(_close)
+        return b""
+
+    def discard(self):
+        self.chunks = []
+        self.buffered = 0
+        self._finish(_discard)
+
+
+class StreamingScrapyAgent(ScrapyAgent):
+    def __init__(self, *, write_size: int, finishing: set, **kwargs):
+        super().__init__(**kwargs)
+        self._write_size = write_size
+        self._finishing = finishing
+
+    def _stream_content_type(self, txresponse) -> Optional[str]:
+        # Content type of a response whose body is streamed to disk, None otherwise.
+        spider = self._crawler.spider
+        if getattr(spider, "streams", None) is None or txresponse.code != 200:
+            return None
+        # Encoded bodies are decoded by HttpCompressionMiddleware after the download.
+        encodings = txresponse.headers.getRawHeaders(b"content-encoding") or []
+        if any(encoding.strip().lower() not in (b"", b"identity") for encoding in encodings):
+            return None
+        content_type = (txresponse.headers.getRawHeaders(b"content-type") or [b""])[0].decode("latin1")
+        return content_type if spider.streams(content_type) else None
+
+    def _cb_bodyready(self, txresponse, request: Request):
+        content_type = self._stream_content_type(txresponse)
+        if content_type is None:
+            return super()._cb_bodyready(txresponse, request)
+
+        spider = self._crawler.spider
+        deliver_body = txresponse.deliverBody
+        streamed: [StreamedBody] = []
+
+        # The body reader is only created when there is a body to deliver.
+        def deliver_to_file(reader):
+            path = spider.physical_path(request.url, content_type)
+            reader._bodybuf = StreamedBody(reader, deferToThread(spider.open_stream, path),
+                                           self._write_size, self._finishing)
+            request.meta["saved_path"] = str(path)
+            streamed.append(reader._bodybuf)
+            deliver_body(reader)
+
+        def discard(failure: Failure) -> Failure:
+            for body in streamed:
+                body.discard()
+            request.meta.pop("saved_path", None)
+            return failure
+
+        txresponse.deliverBody = deliver_to_file
+        result = super()._cb_bodyready(txresponse, request)
+        if isinstance(result, Deferred):
+            result.addErrback(discard)
+        return result
+
+
+class StreamingDownloadHandler(HTTP11DownloadHandler):
+    WRITE_SIZE: int = 1 << 20
+
+    def __init__(self, settings, crawler=None):
+        super().__init__(settings, crawler)
+        # Bodies whose last writes are still running on the thread pool.
+        self._finishing: set = set()
+
+    def download_request(self, request: Request, spider: Spider) -> Deferred:
+        agent = StreamingScrapyAgent(
+            contextFactory=self._contextFactory,
+            pool=self._pool,
+            maxsize=getattr(spider, "download_maxsize", self._default_maxsize),
+            warnsize=getattr(spider, "download_warnsize", self._default_warnsize),
+            fail_on_dataloss=self._fail_on_dataloss,
+            crawler=self._crawler,
+            write_size=getattr(spider, "SAVE_FILE_BUFFER_SIZE", self.WRITE_SIZE),
+            finishing=self._finishing,
+        )
+        return agent.download_request(request)
+
+    @inlineCallbacks
+    def close(self):
+        yield DeferredList(list(self._finishing))
+        yield super().close()